@@ -0,0 +1,171 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+
+import vm_monitor_api
+import vm_monitor_client
+from vm_monitor_api import create_app, VMMonitorAPI
+from vm_monitor_client import GPUType, VMMonitor
+from vm_monitor_db import get_session, pack_cpu_usages, Sample, MemoryUsage, DiskUsage
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+IDLE = ([10.0, 30.0], 1000)
+BUSY = ([90.0, 90.0], 2000)
+
+# hourly reports around midnight, two of them in the same hour
+REPORTS = [ (datetime(2026, 5, 1, 23), IDLE),
+            (datetime(2026, 5, 2, 0), IDLE),
+            (datetime(2026, 5, 2, 0, 30), BUSY),
+            (datetime(2026, 5, 2, 6), IDLE)]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def make_sample(timestamp, cpu_usages, mem_used_mb):
+    sample = Sample(timestamp=timestamp,
+                    cpu_count=len(cpu_usages),
+                    gpu_count=0,
+                    cpu_usages=pack_cpu_usages(cpu_usages))
+    sample.memory = MemoryUsage(total_mb=4000, used_mb=mem_used_mb)
+    sample.disk = DiskUsage(total_mb=10000, used_mb=5000)
+    return sample
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def write_reports(db_file_path, reports, monkeypatch):
+    """Feed reports through the monitor's writer"""
+
+    monkeypatch.setattr(vm_monitor_client, 'check_gpu_type', lambda: GPUType.CPU_ONLY)
+
+    monitor = VMMonitor(sample_interval=5, report_interval=3600, db_file_path=db_file_path)
+    for timestamp, (cpu_usages, mem_used_mb) in reports:
+        monitor._db_queue.put(make_sample(timestamp, cpu_usages, mem_used_mb))
+    monitor.close()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """An API test client over a database filled by the monitor's writer"""
+
+    db_file_path = str(tmp_path / 'vm_monitor.db')
+    write_reports(db_file_path, REPORTS, monkeypatch)
+    return create_app(db_file_path).test_client()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def get_data(client, **params):
+    response = client.get('/get_usage_data', query_string=params)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['status'] == 'success'
+    assert body['count'] == len(body['data'])
+    return body['data']
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_raw_rows_are_one_per_report(client):
+    data = get_data(client, start='2026-05-02', end='2026-05-02')
+
+    assert [row['timestamp'] for row in data] == ['2026-05-02T00:00:00', '2026-05-02T00:30:00', '2026-05-02T06:00:00']
+
+    assert set(data[0]) == {'timestamp', 'cpu_count', 'gpu_count', 'cpus', 'gpus', 'disk', 'memory'}
+    assert data[0]['cpus'] == [ {'cpu_index': 0, 'usage_percent': 10.0},
+                                {'cpu_index': 1, 'usage_percent': 30.0}]
+    assert data[0]['memory'] == {'total_mb': 4000, 'used_mb': 1000}
+    assert data[0]['gpus'] == []
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_day_buckets(client):
+    data = get_data(client, start='2026-05-02', end='2026-05-02', bucket='day')
+
+    assert [row['bucket'] for row in data] == ['2026-05-02']
+    [day] = data
+    assert day['sample_count'] == 3
+    assert day['cpu'] == {'avg_percent': pytest.approx((20 + 90 + 20) / 3), 'max_percent': 90.0}
+    assert day['memory'] == {'avg_used_mb': pytest.approx((1000 + 2000 + 1000) / 3),
+                             'max_used_mb': 2000,
+                             'total_mb': 4000}
+    assert day['gpu'] is None
+
+    data = get_data(client, start='2026-05-01', end='2026-05-02', bucket='day')
+    assert [(row['bucket'], row['sample_count']) for row in data] == [('2026-05-01', 1), ('2026-05-02', 3)]
+    assert data[0]['cpu'] == {'avg_percent': 20.0, 'max_percent': 30.0}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_hour_buckets_stay_within_range(client):
+    data = get_data(client, start='2026-05-02', end='2026-05-02', bucket='hour')
+
+    assert [(row['bucket'], row['sample_count']) for row in data] == [
+        ('2026-05-02 00:00', 2),
+        ('2026-05-02 06:00', 1)]
+    assert data[0]['cpu'] == {'avg_percent': pytest.approx((20 + 90) / 2), 'max_percent': 90.0}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_cpu_summary_defaults_from_cpu_usages(tmp_path):
+    session = get_session(str(tmp_path / 'vm_monitor.db'))
+    session.add_all([   Sample(timestamp=datetime(2026, 5, 2, 12), cpu_count=3, gpu_count=0,
+                               cpu_usages=pack_cpu_usages([10.0, 50.0, 30.0])),
+                        Sample(timestamp=datetime(2026, 5, 2, 13), cpu_count=0, gpu_count=0)])
+    session.commit()
+
+    rows = session.execute(select(Sample.cpu_avg_percent, Sample.cpu_max_percent).order_by(Sample.timestamp)).all()
+    assert [tuple(row) for row in rows] == [(30.0, 50.0), (None, None)]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_bucketed_query_only_reads_samples_in_range(tmp_path):
+    api = VMMonitorAPI(db_file_path=str(tmp_path / 'vm_monitor.db'))
+    query = api.get_aggregated_query(datetime(2026, 5, 2), datetime(2026, 5, 2, 23), 'day')
+
+    with api._engine.connect() as conn:
+        compiled = query.compile(conn, compile_kwargs={'literal_binds': True})
+        plan = [row.detail for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")]
+
+    # no table, gpu_usage included, is scanned end to end
+    assert not [step for step in plan if step.startswith('SCAN')]
+    assert 'SEARCH gpu_usage USING COVERING INDEX ix_gpu_usage_sample_cover (sample_id=?)' in plan
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_serve_leaves_the_database_to_the_workers(tmp_path, monkeypatch):
+    opened = []
+    servers = []
+    get_session_factory = vm_monitor_api.get_session_factory
+    monkeypatch.setattr(vm_monitor_api, 'get_session_factory',
+                        lambda path: opened.append(path) or get_session_factory(path))
+    monkeypatch.setattr(vm_monitor_api.GunicornServer, 'run', lambda server: servers.append(server))
+
+    db_file_path = str(tmp_path / 'vm_monitor.db')
+    vm_monitor_api.serve(db_file_path, host='127.0.0.1', port=8000)
+
+    # the master only configures gunicorn; each worker opens the database in load()
+    assert opened == []
+    [server] = servers
+    assert server.cfg.bind == ['127.0.0.1:8000']
+    server.load()
+    assert opened == [db_file_path]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_cpus_are_reported_with_their_cpu_id(tmp_path, monkeypatch):
+    db_file_path = str(tmp_path / 'vm_monitor.db')
+    monkeypatch.setattr(vm_monitor_client, 'check_gpu_type', lambda: GPUType.CPU_ONLY)
+    monkeypatch.setattr(vm_monitor_client, 'get_online_cpus', lambda: [0, 1, 2, 3])
+    monkeypatch.setattr(vm_monitor_client, 'get_available_cpus', lambda: [0, 2])
+    monkeypatch.setattr(vm_monitor_client.psutil, 'cpu_percent', lambda interval, percpu: [1.0, 2.0, 3.0, 4.0])
+
+    monitor = VMMonitor(sample_interval=5, report_interval=3600, db_file_path=db_file_path)
+    monitor.get_current_usage()
+    monitor.update_peak_usage()
+    monitor.log_peak_stats()
+    monitor.close()
+
+    today = datetime.now().date().isoformat()
+    [row] = get_data(create_app(db_file_path).test_client(), start=today, end=today)
+    assert row['cpus'] == [ {'cpu_index': 0, 'usage_percent': 1.0},
+                            {'cpu_index': 2, 'usage_percent': 3.0}]
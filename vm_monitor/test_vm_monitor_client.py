@@ -0,0 +1,439 @@
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+import yaml
+from sqlalchemy import create_engine, func, select
+
+import vm_monitor_client
+from vm_monitor_client import GPUType, VMMonitor
+from vm_monitor_db import unpack_cpu_ids, Sample, GPUUsage
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# prints a numbered reading every 50 ms whatever loop period it is given
+FAST_NVIDIA_SMI = """#!/bin/sh
+i=0
+while true; do
+    i=$((i + 1))
+    echo "0, $i, 100, 1000"
+    sleep 0.05
+done
+"""
+
+# prints a reading every 2 s, slower than the sampler in the tests below
+SLOW_NVIDIA_SMI = """#!/bin/sh
+while true; do
+    echo "0, 7, 100, 1000"
+    sleep 2
+done
+"""
+
+# prints one reading and then hangs
+HUNG_NVIDIA_SMI = """#!/bin/sh
+echo "0, 5, 100, 1000"
+exec sleep 1000
+"""
+
+# prints one line per GPU every 50 ms, like a host with two cards
+TWO_GPU_NVIDIA_SMI = """#!/bin/sh
+while true; do
+    echo "0, 30, 100, 1000"
+    echo "1, 70, 200, 1000"
+    sleep 0.05
+done
+"""
+
+# logs each start to $SPAWN_LOG and exits at once, like a tool that cannot
+# reach the driver
+EXITING_NVIDIA_SMI = """#!/bin/sh
+echo started >> "$SPAWN_LOG"
+exit 9
+"""
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class FakeNVML:
+    """Stands in for pynvml; reload() invalidates handles like a driver reload"""
+
+    class NVMLError(Exception):
+        pass
+
+    def __init__(self, count=1):
+        self.generation = 0
+        self.initialised = 0
+        self.count = count
+
+    def reload(self):
+        self.generation += 1
+
+    def nvmlInit(self):
+        self.initialised += 1
+
+    def nvmlShutdown(self):
+        self.initialised -= 1
+
+    def nvmlDeviceGetCount(self):
+        return self.count
+
+    def nvmlDeviceGetHandleByIndex(self, index):
+        return (self.generation, index)
+
+    def check(self, handle):
+        if handle[0] != self.generation:
+            raise self.NVMLError("GPU is lost")
+
+    def nvmlDeviceGetUtilizationRates(self, handle):
+        self.check(handle)
+        return SimpleNamespace(gpu=42)
+
+    def nvmlDeviceGetMemoryInfo(self, handle):
+        self.check(handle)
+        return SimpleNamespace(used=512 * 1024 * 1024, total=1024 * 1024 * 1024)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@pytest.fixture
+def make_monitor(tmp_path, monkeypatch):
+    """Build a VMMonitor that talks to a fake nvidia-smi"""
+
+    monitors = []
+
+    def make(nvidia_smi_script, **kwargs):
+        bin_dir = tmp_path / 'bin'
+        bin_dir.mkdir(exist_ok=True)
+        nvidia_smi = bin_dir / 'nvidia-smi'
+        nvidia_smi.write_text(nvidia_smi_script)
+        nvidia_smi.chmod(0o755)
+
+        monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}")
+        monkeypatch.setattr(vm_monitor_client, 'check_gpu_type', lambda: GPUType.NVIDIA_GPU)
+        monkeypatch.setattr(vm_monitor_client, 'pynvml', None)
+
+        kwargs.setdefault('db_file_path', str(tmp_path / 'vm_monitor.db'))
+        monitor = VMMonitor(**kwargs)
+        monitors.append(monitor)
+        return monitor
+
+    yield make
+
+    for monitor in monitors:
+        monitor.close()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def wait_for_first_reading(monitor, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while monitor._smi_reading[1] is None:
+        assert time.monotonic() < deadline, "nvidia-smi never printed a line"
+        time.sleep(0.01)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_smi_reading_is_the_newest_line(make_monitor):
+    monitor = make_monitor(FAST_NVIDIA_SMI, sample_interval=1.5, report_interval=60)
+    assert monitor._smi is not None
+    wait_for_first_reading(monitor)
+
+    first, _, _ = monitor.read_gpu_usage()
+    time.sleep(1.0)
+    second, mem_used, mem_total = monitor.read_gpu_usage()
+
+    # a reader that took one line per call would be one line further on
+    assert second - first > 5
+    assert (mem_used, mem_total) == (100, 1000)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_smi_reading_covers_every_gpu(make_monitor):
+    monitor = make_monitor(TWO_GPU_NVIDIA_SMI, sample_interval=1.5, report_interval=60)
+    wait_for_first_reading(monitor)
+    time.sleep(0.2)
+
+    # the busiest card and the memory of both, as the NVML path reports them
+    assert monitor.read_gpu_usage() == (70, 300, 2000)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_slow_smi_does_not_hold_up_sampling(make_monitor):
+    monitor = make_monitor(SLOW_NVIDIA_SMI, sample_interval=0.1, report_interval=60)
+    wait_for_first_reading(monitor)
+
+    # every poll between two lines reuses the newest one instead of waiting
+    started = time.monotonic()
+    readings = [monitor.read_gpu_usage() for _ in range(10)]
+    assert time.monotonic() - started < 0.5
+    assert readings == [(7, 100, 1000)] * 10
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_hung_smi_backs_off_and_restarts(make_monitor, monkeypatch):
+    # a 2 s loop period makes a reading stale after 0.5 s
+    monkeypatch.setattr(vm_monitor_client, 'SMI_STALE_PERIODS', 0.25)
+    monitor = make_monitor(HUNG_NVIDIA_SMI, sample_interval=1, report_interval=60)
+    wait_for_first_reading(monitor)
+
+    monitor.get_current_gpu_usage()
+    assert monitor.current_usage_stats.gpu_proc == 5
+    assert monitor._gpu_failures == 0
+
+    hung = monitor._smi
+    time.sleep(0.6)
+    monitor._gpu_last_poll = 0.0
+    monitor.get_current_gpu_usage()
+
+    assert monitor._gpu_failures == 1
+    assert monitor._gpu_next_poll > time.monotonic()
+    assert monitor.current_usage_stats.gpu_proc == 0
+    assert hung.poll() is not None
+
+    # once the back-off runs out the next poll starts a new nvidia-smi, and
+    # its first reading ends the back-off
+    monitor._gpu_last_poll = monitor._gpu_next_poll = 0.0
+    monitor.get_current_gpu_usage()
+    assert monitor._smi is not hung
+    wait_for_first_reading(monitor)
+    monitor._gpu_last_poll = 0.0
+    monitor.get_current_gpu_usage()
+    assert monitor._gpu_failures == 0
+    assert monitor.current_usage_stats.gpu_proc == 5
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_exiting_smi_is_started_once_per_back_off(make_monitor, monkeypatch, tmp_path):
+    spawn_log = tmp_path / 'spawns'
+    monkeypatch.setenv('SPAWN_LOG', str(spawn_log))
+    monkeypatch.setattr(vm_monitor_client, 'GPU_BACKOFF_MAX', 0.5)
+    monitor = make_monitor(EXITING_NVIDIA_SMI, sample_interval=0.5, report_interval=60)
+
+    # poll far more often than the back-off allows
+    deadline = time.monotonic() + 3.0
+    while time.monotonic() < deadline:
+        monitor._gpu_last_poll = 0.0
+        monitor.get_current_gpu_usage()
+        assert monitor.current_usage_stats.gpu_proc == 0
+        time.sleep(0.02)
+
+    monitor._smi.wait()
+    spawns = len(spawn_log.read_text().splitlines())
+    assert monitor._gpu_failures >= 3
+    assert spawns in (monitor._gpu_failures, monitor._gpu_failures + 1)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_nvml_is_reinitialised_after_a_driver_reload(tmp_path, monkeypatch):
+    nvml = FakeNVML()
+    monkeypatch.setattr(vm_monitor_client, 'check_gpu_type', lambda: GPUType.NVIDIA_GPU)
+    monkeypatch.setattr(vm_monitor_client, 'pynvml', nvml)
+
+    monitor = VMMonitor(sample_interval=1, report_interval=60, db_file_path=str(tmp_path / 'vm_monitor.db'))
+    try:
+        monitor.get_current_gpu_usage()
+        assert (monitor.current_usage_stats.gpu_proc, monitor.current_usage_stats.gpu_mem_used) == (42, 512)
+
+        nvml.reload()
+        monitor._gpu_last_poll = 0.0
+        monitor.get_current_gpu_usage()
+        assert monitor._gpu_failures == 1
+        assert monitor.current_usage_stats.gpu_proc == 0
+        assert nvml.initialised == 0
+
+        # the first poll after the back-off gets fresh handles
+        monitor._gpu_last_poll = monitor._gpu_next_poll = 0.0
+        monitor.get_current_gpu_usage()
+        assert monitor._gpu_failures == 0
+        assert monitor.current_usage_stats.gpu_proc == 42
+    finally:
+        monitor.close()
+
+    assert nvml.initialised == 0
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_nvml_without_devices_is_shut_down(tmp_path, monkeypatch):
+    nvml = FakeNVML(count=0)
+    monkeypatch.setattr(vm_monitor_client, 'check_gpu_type', lambda: GPUType.NVIDIA_GPU)
+    monkeypatch.setattr(vm_monitor_client, 'pynvml', nvml)
+    monkeypatch.setenv('PATH', str(tmp_path))
+
+    # at start-up, with no nvidia-smi to fall back to either
+    monitor = VMMonitor(sample_interval=1, report_interval=60, db_file_path=str(tmp_path / 'start.db'))
+    monitor.close()
+    assert nvml.initialised == 0
+    assert monitor.gpu_type == GPUType.CPU_ONLY
+
+    # and on every retry after the devices went away
+    nvml.count = 1
+    monitor = VMMonitor(sample_interval=1, report_interval=60, db_file_path=str(tmp_path / 'retry.db'))
+    try:
+        nvml.reload()
+        nvml.count = 0
+        for _ in range(3):
+            monitor._gpu_last_poll = monitor._gpu_next_poll = 0.0
+            monitor.get_current_gpu_usage()
+            assert nvml.initialised == 0
+        assert monitor._gpu_failures == 3
+    finally:
+        monitor.close()
+
+    assert nvml.initialised == 0
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_amd_gpu_is_monitored_as_cpu_only(tmp_path, monkeypatch):
+    db_file_path = tmp_path / 'vm_monitor.db'
+    monkeypatch.setattr(vm_monitor_client, 'check_gpu_type', lambda: GPUType.AMD_GPU)
+
+    monitor = VMMonitor(sample_interval=1, report_interval=60, db_file_path=str(db_file_path))
+    monitor.get_current_usage()
+    monitor.update_peak_usage()
+    monitor.log_peak_stats()
+    monitor.close()
+
+    assert (monitor.gpu_type, monitor.num_gpus) == (GPUType.CPU_ONLY, 0)
+    engine = create_engine(f'sqlite:///{db_file_path}')
+    with engine.connect() as conn:
+        assert conn.execute(select(Sample.gpu_count)).scalar_one() == 0
+        assert conn.execute(select(func.count()).select_from(GPUUsage)).scalar_one() == 0
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def count_samples(conn):
+    try:
+        return conn.execute("SELECT count(*) FROM samples").fetchone()[0]
+    except sqlite3.OperationalError:
+        # the client has not created the schema yet
+        return 0
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_sigterm_flushes_queued_samples(tmp_path):
+    db_file_path = tmp_path / 'vm_monitor.db'
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text(yaml.safe_dump({ 'sample_interval': 0.05,
+                                            'report_interval': 0.2,
+                                            'db_file_path': str(db_file_path)}))
+
+    client = subprocess.Popen([sys.executable, vm_monitor_client.__file__, '--config', str(config_path)],
+                              cwd=os.path.dirname(vm_monitor_client.__file__),
+                              stdout=subprocess.DEVNULL)
+    conn = sqlite3.connect(db_file_path, isolation_level=None, timeout=30)
+    try:
+        # wait for the client to be up and writing
+        deadline = time.monotonic() + 30.0
+        while count_samples(conn) == 0:
+            assert client.poll() is None, "client exited before writing a sample"
+            assert time.monotonic() < deadline, "client never wrote a sample"
+            time.sleep(0.05)
+
+        # hold the write lock so further reports can only reach the database
+        # through the flush close() does on the way out
+        conn.execute("BEGIN IMMEDIATE")
+        written = count_samples(conn)
+        time.sleep(1.0)
+
+        client.send_signal(signal.SIGTERM)
+        with pytest.raises(subprocess.TimeoutExpired):
+            client.wait(timeout=1.0)
+        conn.execute("ROLLBACK")
+
+        assert client.wait(timeout=30) == 0
+        assert count_samples(conn) > written
+    finally:
+        conn.close()
+        if client.poll() is None:
+            client.kill()
+            client.wait()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class FakeClock:
+    """Stands in for the time module; sleeping advances the clock at once"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        assert seconds >= 0
+        self.now += seconds
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class StopRun(Exception):
+    pass
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@pytest.mark.parametrize('stall, stop, expected_samples, expected_reports', [
+    # no stall: a report every 10 s, on the sample that reaches it
+    (0, 136, list(range(100, 136)), [110, 120, 130]),
+    # the sample at 105 takes 27 s: ticks 106 to 132 are skipped, the late
+    # report runs at 132 and the next one keeps to the 140 deadline
+    (27, 142, list(range(100, 106)) + list(range(133, 142)), [132, 140]),
+    # a stall across several report deadlines gives one report, not a burst
+    (47, 162, list(range(100, 106)) + list(range(153, 162)), [152, 160]),
+])
+def test_run_skips_missed_samples_and_reports(tmp_path, monkeypatch, stall, stop, expected_samples, expected_reports):
+    clock = FakeClock(100)
+    samples = []
+    reports = []
+
+    def get_current_usage():
+        if clock.now >= stop:
+            raise StopRun()
+        samples.append(clock.now)
+        if clock.now == 105:
+            clock.now += stall
+
+    monkeypatch.setattr(vm_monitor_client, 'check_gpu_type', lambda: GPUType.CPU_ONLY)
+    monitor = VMMonitor(sample_interval=1, report_interval=10, db_file_path=str(tmp_path / 'vm_monitor.db'))
+    try:
+        monkeypatch.setattr(vm_monitor_client, 'time', clock)
+        monkeypatch.setattr(monitor, 'get_current_usage', get_current_usage)
+        monkeypatch.setattr(monitor, 'log_peak_stats', lambda: reports.append(clock.now))
+
+        with pytest.raises(StopRun):
+            monitor.run()
+    finally:
+        monitor.close()
+
+    assert samples == expected_samples
+    assert reports == expected_reports
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@pytest.mark.parametrize('online, affinity, listed, expected, expected_ids', [
+    ([0, 1, 2, 3], [0, 2], [1.0, 2.0, 3.0, 4.0], [1.0, 3.0], [0, 2]),
+    # CPU 1 offline: psutil lists cpu0, cpu2 and cpu3
+    ([0, 2, 3], [0, 2, 3], [1.0, 2.0, 3.0], [1.0, 2.0, 3.0], [0, 2, 3]),
+    ([0, 2, 3], [0, 2], [1.0, 2.0, 3.0], [1.0, 2.0], [0, 2]),
+    # lxcfs: psutil lists the container's two CPUs as cpu0 and cpu1
+    ([0, 1, 2, 3, 4, 5, 6, 7], [4, 5], [1.0, 2.0], [1.0, 2.0], [0, 1]),
+])
+def test_cpu_usage_follows_the_listed_cpus(tmp_path, monkeypatch, online, affinity, listed, expected, expected_ids):
+    readings = iter([listed, listed, listed[:2]])
+    monkeypatch.setattr(vm_monitor_client, 'check_gpu_type', lambda: GPUType.CPU_ONLY)
+    monkeypatch.setattr(vm_monitor_client, 'get_online_cpus', lambda: online)
+    monkeypatch.setattr(vm_monitor_client, 'get_available_cpus', lambda: affinity)
+    monkeypatch.setattr(vm_monitor_client.psutil, 'cpu_percent', lambda interval, percpu: next(readings))
+
+    monitor = VMMonitor(sample_interval=1, report_interval=60, db_file_path=str(tmp_path / 'vm_monitor.db'))
+    try:
+        monitor.get_current_usage()
+        assert monitor.current_usage_stats.cpu.tolist() == expected
+        assert unpack_cpu_ids(monitor._packed_cpu_ids, monitor.num_cpus).tolist() == expected_ids
+
+        # a CPU going offline re-sizes the stats instead of indexing past the list
+        monitor.get_current_usage()
+        assert monitor.current_usage_stats.cpu.tolist() == listed[:2]
+        assert monitor.peak_usage_stats.cpu.shape == (2,)
+    finally:
+        monitor.close()
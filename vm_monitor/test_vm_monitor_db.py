@@ -0,0 +1,141 @@
+import multiprocessing
+import sqlite3
+
+import numpy as np
+import pytest
+from sqlalchemy import inspect, select
+
+from vm_monitor_db import create_database_engine, unpack_cpu_usages, Sample
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# the schema written by versions that stored one cpu_usage row per CPU per sample
+BASELINE_SCHEMA = """
+CREATE TABLE samples (
+    id INTEGER NOT NULL PRIMARY KEY,
+    timestamp DATETIME,
+    cpu_count INTEGER,
+    gpu_count INTEGER
+);
+CREATE INDEX ix_samples_timestamp ON samples (timestamp);
+CREATE TABLE cpu_usage (
+    id INTEGER NOT NULL PRIMARY KEY,
+    sample_id INTEGER REFERENCES samples (id) ON DELETE CASCADE,
+    cpu_index INTEGER,
+    usage_percent FLOAT
+);
+CREATE INDEX ix_cpu_usage_sample_id ON cpu_usage (sample_id);
+CREATE TABLE gpu_usage (
+    id INTEGER NOT NULL PRIMARY KEY,
+    sample_id INTEGER REFERENCES samples (id) ON DELETE CASCADE,
+    gpu_index INTEGER,
+    usage_percent FLOAT,
+    memory_used_mb FLOAT,
+    memory_total_mb FLOAT
+);
+CREATE INDEX ix_gpu_usage_sample_id ON gpu_usage (sample_id);
+CREATE TABLE disk_usage (
+    id INTEGER NOT NULL PRIMARY KEY,
+    sample_id INTEGER REFERENCES samples (id) ON DELETE CASCADE,
+    total_mb FLOAT,
+    used_mb FLOAT
+);
+CREATE INDEX ix_disk_usage_sample_id ON disk_usage (sample_id);
+CREATE TABLE memory_usage (
+    id INTEGER NOT NULL PRIMARY KEY,
+    sample_id INTEGER REFERENCES samples (id) ON DELETE CASCADE,
+    total_mb FLOAT,
+    used_mb FLOAT
+);
+CREATE UNIQUE INDEX ix_memory_usage_sample_id ON memory_usage (sample_id);
+"""
+
+# sample id -> per-CPU usage, in cpu_index order
+BASELINE_CPU_USAGES = {
+    1: [10.5, 20.0, 30.25, 40.0],
+    2: [99.0, 0.0, 50.5, 1.0],
+    3: [],
+}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@pytest.fixture
+def baseline_db(tmp_path):
+    """A database written with the baseline schema"""
+
+    path = tmp_path / 'baseline.db'
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+
+    for sample_id, usages in BASELINE_CPU_USAGES.items():
+        conn.execute("INSERT INTO samples (id, timestamp, cpu_count, gpu_count) VALUES (?, ?, ?, 0)",
+                     (sample_id, f'2026-05-0{sample_id} 12:00:00.000000', len(usages)))
+
+    # insert the per-CPU rows in reverse so the migration has to sort them
+    for sample_id, usages in reversed(BASELINE_CPU_USAGES.items()):
+        for cpu_index in reversed(range(len(usages))):
+            conn.execute("INSERT INTO cpu_usage (sample_id, cpu_index, usage_percent) VALUES (?, ?, ?)",
+                         (sample_id, cpu_index, usages[cpu_index]))
+
+    conn.commit()
+    conn.close()
+    return path
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_upgrade_packs_cpu_usage_in_cpu_order(baseline_db):
+    engine = create_database_engine(baseline_db)
+
+    with engine.connect() as conn:
+        rows = conn.execute(select(Sample.id, Sample.cpu_usages, Sample.cpu_avg_percent, Sample.cpu_max_percent)
+                            .order_by(Sample.id)).all()
+
+    assert [row.id for row in rows] == list(BASELINE_CPU_USAGES)
+    for row in rows:
+        expected = np.asarray(BASELINE_CPU_USAGES[row.id], dtype=np.float32)
+        np.testing.assert_array_equal(unpack_cpu_usages(row.cpu_usages), expected)
+        if expected.size:
+            assert (row.cpu_avg_percent, row.cpu_max_percent) == (pytest.approx(expected.mean()), expected.max())
+        else:
+            assert (row.cpu_avg_percent, row.cpu_max_percent) == (None, None)
+
+    inspector = inspect(engine)
+    assert not inspector.has_table('cpu_usage')
+    gpu_indexes = {index['name'] for index in inspector.get_indexes('gpu_usage')}
+    assert 'ix_gpu_usage_sample_cover' in gpu_indexes
+    assert 'ix_gpu_usage_sample_id' not in gpu_indexes
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def test_upgrade_is_idempotent(baseline_db):
+    create_database_engine(baseline_db).dispose()
+    engine = create_database_engine(baseline_db)
+
+    with engine.connect() as conn:
+        packed = conn.execute(select(Sample.cpu_usages).where(Sample.id == 1)).scalar_one()
+
+    np.testing.assert_array_equal(unpack_cpu_usages(packed),
+                                  np.asarray(BASELINE_CPU_USAGES[1], dtype=np.float32))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _open_database(path, barrier):
+    barrier.wait()
+    create_database_engine(path).dispose()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@pytest.mark.parametrize('fresh', [False, True])
+def test_concurrent_upgrades(baseline_db, fresh):
+    path = baseline_db.with_name('fresh.db') if fresh else baseline_db
+
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(3)
+    processes = [context.Process(target=_open_database, args=(path, barrier)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+
+    assert [process.exitcode for process in processes] == [0, 0, 0]
+    assert not inspect(create_database_engine(path)).has_table('cpu_usage')
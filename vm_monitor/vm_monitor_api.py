@@ -2,11 +2,17 @@
 
 import datetime
 import argparse
+import functools
+import itertools
 import yaml
-from flask import Flask, jsonify, request
+import orjson
+from flask import Flask, Response, jsonify, request, stream_with_context
+from gunicorn.app.base import BaseApplication
 from contextlib import contextmanager
+from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload
 
-from vm_monitor_db import get_session, Sample, CPUUsage, MemoryUsage, DiskUsage, GPUUsage
+from vm_monitor_db import get_session_factory, unpack_cpu_usages, unpack_cpu_ids, Sample, MemoryUsage, DiskUsage, GPUUsage
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -16,6 +22,16 @@ DB_FILE_PATH = 'db_file_path'      # directory to store log files
 
 REQUIRED_KEYS = [HOST_IP, PORT_NUMBER, DB_FILE_PATH]
 
+SAMPLE_BATCH_SIZE = 500            # samples fetched from the database per round trip
+DATE_CACHE_SIZE = 512              # parsed start/end date strings kept in memory
+
+# strftime formats used to group samples for the bucket query parameter
+BUCKET_FORMATS = {  'hour': '%Y-%m-%d %H:00',
+                    'day': '%Y-%m-%d'}
+
+API_WORKERS = 2                    # gunicorn worker processes
+API_THREADS = 4                    # request threads per worker
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 class VMMonitorAPI:
@@ -31,12 +47,17 @@ class VMMonitorAPI:
 
         self.database_path = db_file_path
 
+        # one engine per process, shared with anything else that opens this
+        # file; sessions are cheap checkouts from its pool
+        self._Session = get_session_factory(db_file_path)
+        self._engine = self._Session.kw['bind']
+
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     @contextmanager
     def get_db_session(self):
         """Context manager for database sessions"""
-        session = get_session(self.database_path)
+        session = self._Session(expire_on_commit=False)
         try:
             yield session
         except Exception as e:
@@ -56,19 +77,25 @@ class VMMonitorAPI:
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def get_data_in_range(self, start_date, end_date):
-        """Get usage data from database within date range"""
+        """Yield usage data from database within date range"""
         with self.get_db_session() as session:
-            # Query samples in date range
-            samples = session.query(Sample).filter( Sample.timestamp >= start_date,
-                                                    Sample.timestamp <= end_date).all()
+            # Query samples in date range, loading each child table with one
+            # extra SELECT per batch instead of one per sample
+            samples = session.query(Sample).options(selectinload(Sample.gpus),
+                                                    selectinload(Sample.disk),
+                                                    selectinload(Sample.memory))\
+                                            .filter(Sample.timestamp.between(start_date, end_date))\
+                                            .order_by(Sample.timestamp)\
+                                            .yield_per(SAMPLE_BATCH_SIZE)
 
-            usage_data = []
             for sample in samples:
+                cpu_usages = unpack_cpu_usages(sample.cpu_usages)
+                cpu_ids = unpack_cpu_ids(sample.cpu_ids, cpu_usages.size)
                 sample_data = { 'timestamp': sample.timestamp.isoformat(),
                                 'cpu_count': sample.cpu_count,
                                 'gpu_count': sample.gpu_count,
-                    'cpus': [ { 'cpu_index': cpu.cpu_index,
-                                'usage_percent': cpu.usage_percent,} for cpu in sample.cpus],
+                    'cpus': [ { 'cpu_index': cpu_id,
+                                'usage_percent': round(usage, 1)} for cpu_id, usage in zip(cpu_ids.tolist(), cpu_usages.tolist())],
                     'gpus': [{  'gpu_index': gpu.gpu_index,
                                 'usage_percent': gpu.usage_percent,
                                 'memory_used_mb': gpu.memory_used_mb,
@@ -78,20 +105,101 @@ class VMMonitorAPI:
                     'memory': { 'total_mb': sample.memory.total_mb,
                                 'used_mb': sample.memory.used_mb} if sample.memory else None
                 }
-                usage_data.append(sample_data)
+                yield sample_data
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def get_aggregated_query(self, start_date, end_date, bucket):
+        """Select one row per hour or day in date range with the aggregated readings"""
+
+        # reduce the GPU rows to one row per sample first so that every sample
+        # weighs the same in the bucket averages; only the samples in range are
+        # reduced, not the whole history
+        gpu = select(   GPUUsage.sample_id,
+                        func.max(GPUUsage.usage_percent).label('max_percent'),
+                        func.sum(GPUUsage.memory_used_mb).label('memory_used_mb'),
+                        func.sum(GPUUsage.memory_total_mb).label('memory_total_mb'))\
+                    .join(Sample, Sample.id == GPUUsage.sample_id)\
+                    .filter(Sample.timestamp.between(start_date, end_date))\
+                    .group_by(GPUUsage.sample_id).subquery()
+
+        bucket_key = func.strftime(BUCKET_FORMATS[bucket], Sample.timestamp).label('bucket')
+
+        # CPU is averaged over each sample's mean across CPUs, and its maximum
+        # is the busiest single CPU
+        return select(  bucket_key,
+                        func.count(Sample.id).label('sample_count'),
+                        func.avg(Sample.cpu_avg_percent).label('cpu_avg'),
+                        func.max(Sample.cpu_max_percent).label('cpu_max'),
+                        func.avg(gpu.c.max_percent).label('gpu_avg'),
+                        func.max(gpu.c.max_percent).label('gpu_max'),
+                        func.max(gpu.c.memory_used_mb).label('gpu_mem_used_max'),
+                        func.max(gpu.c.memory_total_mb).label('gpu_mem_total'),
+                        func.avg(MemoryUsage.used_mb).label('mem_used_avg'),
+                        func.max(MemoryUsage.used_mb).label('mem_used_max'),
+                        func.max(MemoryUsage.total_mb).label('mem_total'),
+                        func.avg(DiskUsage.used_mb).label('disk_used_avg'),
+                        func.max(DiskUsage.used_mb).label('disk_used_max'),
+                        func.max(DiskUsage.total_mb).label('disk_total'))\
+                    .select_from(Sample)\
+                    .outerjoin(gpu, gpu.c.sample_id == Sample.id)\
+                    .outerjoin(MemoryUsage, MemoryUsage.sample_id == Sample.id)\
+                    .outerjoin(DiskUsage, DiskUsage.sample_id == Sample.id)\
+                    .filter(Sample.timestamp.between(start_date, end_date))\
+                    .group_by(bucket_key)\
+                    .order_by(bucket_key)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def get_aggregated_data_in_range(self, start_date, end_date, bucket):
+        """Yield usage data aggregated per hour or day within date range"""
 
-            return usage_data
+        query = self.get_aggregated_query(start_date, end_date, bucket)
+
+        with self.get_db_session() as session:
+            for row in session.execute(query):
+                yield { 'bucket': row.bucket,
+                        'sample_count': row.sample_count,
+                        'cpu': {    'avg_percent': row.cpu_avg,
+                                    'max_percent': row.cpu_max},
+                        'gpu': {    'avg_percent': row.gpu_avg,
+                                    'max_percent': row.gpu_max,
+                                    'max_memory_used_mb': row.gpu_mem_used_max,
+                                    'memory_total_mb': row.gpu_mem_total} if row.gpu_max is not None else None,
+                        'disk': {   'avg_used_mb': row.disk_used_avg,
+                                    'max_used_mb': row.disk_used_max,
+                                    'total_mb': row.disk_total},
+                        'memory': { 'avg_used_mb': row.mem_used_avg,
+                                    'max_used_mb': row.mem_used_max,
+                                    'total_mb': row.mem_total}}
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def stream_usage_data(self, records):
+        """Serialize records into a JSON response body one record at a time"""
+        separator = b'{"status":"success","data":['
+        count = 0
+        for record in records:
+            yield separator + orjson.dumps(record)
+            separator = b','
+            count += 1
+
+        yield (separator if count == 0 else b'') + b'],"count":%d}' % count
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def get_start_date(self, start_date_str):
+    @staticmethod
+    @functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+    def get_start_date(start_date_str):
         """Convert date string to datetime at start of day"""
         start_date = datetime.datetime.fromisoformat(start_date_str)
         return start_date.replace(hour=0, minute=0, second=0, microsecond=0)
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def get_end_date(self, end_date_str):
+    @staticmethod
+    @functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+    def get_end_date(end_date_str):
         """Convert date string to datetime at end of day"""
         end_date = datetime.datetime.fromisoformat(end_date_str)
         return end_date.replace(hour=23, minute=59, second=59, microsecond=999999)
@@ -102,20 +210,28 @@ class VMMonitorAPI:
         """Flask route handler for getting usage data"""
         start_date_str = request.args.get('start')
         end_date_str = request.args.get('end')
+        bucket = request.args.get('bucket')
 
         if not start_date_str or not end_date_str:
             return jsonify({'error': 'start and end dates are required'}), 400
 
+        if bucket is not None and bucket not in BUCKET_FORMATS:
+            return jsonify({'error': f'Invalid bucket. Use one of: {", ".join(BUCKET_FORMATS)}'}), 400
+
         try:
             start_date = self.get_start_date(start_date_str)
             end_date = self.get_end_date(end_date_str)
             print(f"Fetching data from {start_date} to {end_date}")
-            data = self.get_data_in_range(start_date, end_date)
-            return jsonify({
-                'status': 'success',
-                'data': data,
-                'count': len(data)
-            })
+            if bucket is None:
+                records = self.get_data_in_range(start_date, end_date)
+            else:
+                records = self.get_aggregated_data_in_range(start_date, end_date, bucket)
+            body = self.stream_usage_data(records)
+
+            # pull the first chunk here so query errors still return a 500
+            first_chunk = next(body)
+            return Response(stream_with_context(itertools.chain([first_chunk], body)),
+                            mimetype='application/json')
 
         except ValueError as e:
             return jsonify({'error': f'Invalid date format. Use ISO format (YYYY-MM-DD): {str(e)}'}), 400
@@ -157,8 +273,59 @@ class VMMonitorAPI:
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def run(self, host='0.0.0.0', port=8000, debug=False):
-        """Run the Flask application"""
-        self.app.run(host=host, port=port, debug=debug)
+        """Run the Flask application under gunicorn, or the dev server when debugging"""
+        if debug:
+            self.app.run(host=host, port=port, debug=debug)
+            return
+
+        # this process becomes the gunicorn master; close its pooled
+        # connections so none is carried across the fork into the workers
+        self._engine.dispose()
+        serve(self.database_path, host=host, port=port)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class GunicornServer(BaseApplication):
+    """Embedded gunicorn server loading the WSGI app from a factory"""
+
+    def __init__(self, app_factory, options):
+        self.app_factory = app_factory
+        self.options = options
+        super().__init__()
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def load(self):
+        return self.app_factory()
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def create_app(db_file_path):
+    """Build the Flask app, e.g. gunicorn 'vm_monitor_api:create_app("/path/to/vm_monitor.db")'"""
+    return VMMonitorAPI(db_file_path=db_file_path).app
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def serve(db_file_path, host='0.0.0.0', port=8000):
+    """Serve the API under gunicorn without opening the database in the master"""
+
+    options = { 'bind': f'{host}:{port}',
+                'workers': API_WORKERS,
+                'worker_class': 'gthread',
+                'threads': API_THREADS}
+
+    # each worker builds its own app after the fork so no database
+    # connection is shared between processes
+    GunicornServer(lambda: create_app(db_file_path), options).run()
 
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -186,8 +353,8 @@ if __name__ == '__main__':
 
     # If all good run the API server
     if validate_config(config):
-        api = VMMonitorAPI(db_file_path=config[DB_FILE_PATH])
-        api.run(host=config[HOST_IP],
-                port=config[PORT_NUMBER])
+        serve(config[DB_FILE_PATH],
+              host=config[HOST_IP],
+              port=config[PORT_NUMBER])
     else:
         print("Invalid configuration. Exiting.")
\ No newline at end of file
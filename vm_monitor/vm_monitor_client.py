@@ -1,18 +1,32 @@
 #!/usr/bin/env python3
+import os
+import sys
+import glob
+import functools
 import psutil
+import numpy as np
 import time
 import logging
 import argparse
 import yaml
+import atexit
+import signal
+import queue
+import threading
 
 from logging.handlers import TimedRotatingFileHandler
-from datetime import datetime, timedelta
+from datetime import datetime
 import subprocess
 from dataclasses import dataclass
 from enum import Enum, auto
 from pprint import pprint
 
-from vm_monitor_db import get_session, Sample, CPUUsage, MemoryUsage, DiskUsage, GPUUsage
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+from vm_monitor_db import get_session, pack_cpu_usages, pack_cpu_ids, Sample, MemoryUsage, DiskUsage, GPUUsage
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 SAMPLE_INTERVAL = 'sample_interval'      # seconds between samples
@@ -23,6 +37,7 @@ REQUIRED_KEYS = [SAMPLE_INTERVAL, REPORT_INTERVAL, DB_FILE_PATH]
 
 # nvidia-smi query parameters
 TIME_STAMP='timestamp'
+CHK_INDEX = 'index'
 CHK_TEMP = 'temperature.gpu'
 CHK_GPU = 'utilization.gpu'
 CHK_MEM = 'utilization.memory'
@@ -30,16 +45,30 @@ CHK_MEM_TOTAL = 'memory.total'
 CHK_MEM_FREE = 'memory.free'
 CHK_MEM_USED = 'memory.used'
 
-QUERIES = f'{CHK_GPU},{CHK_MEM_USED},{CHK_MEM_TOTAL}'
+QUERIES = f'{CHK_INDEX},{CHK_GPU},{CHK_MEM_USED},{CHK_MEM_TOTAL}'
+
+NVIDIA_SMI_COMMAND = ['nvidia-smi', f'--query-gpu={QUERIES}', '--format=csv,noheader,nounits']
+
+# GPU driver probes
+NVIDIA_DRIVER_PATH = '/proc/driver/nvidia/version'
+NVIDIA_DEVICE_GLOB = '/dev/nvidia[0-9]*'
+AMD_KFD_PATH = '/dev/kfd'
+
+CPU_ONLINE_PATH = '/sys/devices/system/cpu/online'
 
-NVIDIA_SMI_COMMAND = f'nvidia-smi --query-gpu={QUERIES} --format=csv,noheader,nounits'
+GPU_CACHE_TTL = 2.0    # seconds a GPU reading is reused before polling again
+GPU_BACKOFF_MAX = 600  # longest pause, in seconds, after repeated GPU poll failures
+SMI_STALE_PERIODS = 3  # nvidia-smi loop periods after which its newest line counts as stale
+
+DB_QUEUE_SIZE = 1024   # samples waiting for the writer thread before new ones are dropped
+DB_WRITE_BATCH = 32    # most samples committed together by the writer thread
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-@dataclass
+@dataclass(slots=True)
 class UsageStats:
 
-    cpu: list[float] = None
+    cpu: np.ndarray = None
     mem_used_mb: int = 0
     mem_total_mb: int = 0
 
@@ -60,7 +89,7 @@ class UsageStats:
 
     def reset(self):
 
-        self.cpu = [0.0] * len(self.cpu)
+        self.cpu.fill(0.0)
         self.mem_used_mb = 0
         self.mem_total_mb = 0
         self.disk_used_mb = 0
@@ -79,6 +108,94 @@ class GPUType(Enum):
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+def has_nvidia_gpu() -> bool:
+
+    # the driver exposes these as soon as it is loaded, no need to run nvidia-smi
+    return os.path.exists(NVIDIA_DRIVER_PATH) or bool(glob.glob(NVIDIA_DEVICE_GLOB))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def has_amd_gpu() -> bool:
+
+    return os.path.exists(AMD_KFD_PATH)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def get_available_cpus() -> list[int]:
+
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is Linux only
+        return list(range(psutil.cpu_count(logical=True)))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def get_online_cpus() -> list[int] | None:
+
+    # the kernel lists the online CPUs as ranges, e.g. "0,2-3"
+    try:
+        with open(CPU_ONLINE_PATH, 'r', encoding='utf-8') as f:
+            ranges = f.read().strip()
+    except OSError:
+        return None
+
+    cpu_ids = []
+    for cpu_range in ranges.split(','):
+        first, _, last = cpu_range.partition('-')
+        cpu_ids.extend(range(int(first), int(last or first) + 1))
+
+    return cpu_ids
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def select_cpus(num_listed : int) -> tuple[list[int], list[int]]:
+
+    # psutil's per-CPU list holds the online CPUs in order, so the affinity
+    # ids are looked up in the online list to find their positions in it.
+    # When the two lists do not line up, e.g. under lxcfs, which renumbers
+    # the CPUs from 0, every listed CPU is used under its position
+    online = get_online_cpus()
+    available = set(get_available_cpus())
+    if online is not None and len(online) == num_listed and available and available <= set(online):
+        positions = [position for position, cpu_id in enumerate(online) if cpu_id in available]
+        return positions, [online[position] for position in positions]
+
+    positions = list(range(num_listed))
+    return positions, positions
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def combine_gpu_readings(readings) -> tuple[int, int, int]:
+
+    # report the busiest device and the combined memory of all devices
+    gpu_proc_usage = 0
+    gpu_mem_used = 0
+    gpu_mem_total = 0
+
+    for proc_usage, mem_used, mem_total in readings:
+        gpu_proc_usage = max(gpu_proc_usage, proc_usage)
+        gpu_mem_used += mem_used
+        gpu_mem_total += mem_total
+
+    return gpu_proc_usage, gpu_mem_used, gpu_mem_total
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+@functools.lru_cache(maxsize=1)
+def check_gpu_type() -> GPUType:
+
+    # the hardware does not change while the process runs, so probe only once
+    if has_nvidia_gpu():
+        return GPUType.NVIDIA_GPU
+
+    if has_amd_gpu():
+        return GPUType.AMD_GPU
+
+    return GPUType.CPU_ONLY
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
 class VMMonitor():
 
     def __init__(   self,
@@ -90,48 +207,230 @@ class VMMonitor():
         self.report_interval = report_interval
         self.db_session = get_session(db_file_path)
 
-        self.gpu_type = self.check_gpu_type()
+        # samples are committed by a writer thread so a slow disk never holds up
+        # sampling; the session is only ever used from that thread
+        self._db_queue = queue.Queue(maxsize=DB_QUEUE_SIZE)
+        self._db_writer = threading.Thread(target=self.db_writer_loop, daemon=True)
+        self._db_writer.start()
+
+        self.gpu_type = check_gpu_type()
+
+        # NVML handles are looked up once and reused for every sample, falling
+        # back to nvidia-smi when the bindings or the library are unavailable
+        self._nvml_handles = None
+        self._nvml_reinit = False
+        if self.gpu_type == GPUType.NVIDIA_GPU:
+            self._nvml_handles = self.init_nvml()
+
+        self._gpu_last_poll = 0.0
+        self._gpu_next_poll = 0.0
+        self._gpu_failures = 0
+        # disk usage is refreshed twice per report interval
+        self._disk_cache = (0.0, None)
+        self._disk_cache_ttl = self.report_interval / 2
+        self._smi = None
+        self._smi_reading = (0.0, None)
+        self._smi_restart = False
+        if self.gpu_type == GPUType.NVIDIA_GPU and not self._nvml_handles:
+            # the driver files can be present with nothing able to query them
+            try:
+                self.start_nvidia_smi()
+            except OSError as e:
+                print(f"No way to query the NVIDIA GPU, monitoring CPU only: {e}")
+                self.gpu_type = GPUType.CPU_ONLY
+        elif self.gpu_type == GPUType.AMD_GPU:
+            # /dev/kfd is also there on APUs and hosts without rocm-smi, and
+            # AMD usage is not read yet; a GPU row would only ever hold zeros
+            print("AMD GPU usage is not supported, monitoring CPU only")
+            self.gpu_type = GPUType.CPU_ONLY
 
         self.num_gpus = 0 if self.gpu_type == GPUType.CPU_ONLY else 1
-        self.num_cpus = psutil.cpu_count(logical=True)
 
-        self.peak_usage_stats = UsageStats(cpu=[0.0] * self.num_cpus)
-        self.current_usage_stats = UsageStats(cpu=[0.0] * self.num_cpus)
+        self.peak_usage_stats = UsageStats()
+        self.current_usage_stats = UsageStats()
+
+        # prime the counters so the first non-blocking read has a baseline
+        self.set_cpus(len(psutil.cpu_percent(interval=None, percpu=True)))
+
+        atexit.register(self.close)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def set_cpus(self, num_listed):
+
+        # only count the CPUs this process may run on, e.g. a container's cpuset
+        self._num_listed_cpus = num_listed
+        self._cpu_positions, cpu_ids = select_cpus(num_listed)
+        self._packed_cpu_ids = pack_cpu_ids(cpu_ids)
+        self.num_cpus = len(cpu_ids)
+
+        self.peak_usage_stats.cpu = np.zeros(self.num_cpus, dtype=np.float32)
+        self.current_usage_stats.cpu = np.zeros(self.num_cpus, dtype=np.float32)
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def check_gpu_type(self):
+    def init_nvml(self):
+
+        if pynvml is None:
+            return None
 
         try:
-            subprocess.run(['nvidia-smi'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
-            return GPUType.NVIDIA_GPU
+            pynvml.nvmlInit()
+        except pynvml.NVMLError:
+            return None
 
-        except Exception as e:
-            pass
+        # the library can load and still fail to enumerate the devices, e.g.
+        # when one has fallen off the bus, or find none at all; use nvidia-smi
+        # in that case too, and shut NVML down so every nvmlInit is matched
+        try:
+            handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
+        except pynvml.NVMLError:
+            handles = None
+
+        if not handles:
+            self.shutdown_nvml()
+            return None
 
+        return handles
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def shutdown_nvml(self):
+
+        # the library may already be gone, e.g. after the driver was unloaded
         try:
-            subprocess.run(['rocm-smi'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
-            return GPUType.AMD_GPU
-        except Exception as e:
+            pynvml.nvmlShutdown()
+        except pynvml.NVMLError:
             pass
 
-        return GPUType.CPU_ONLY
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def start_nvidia_smi(self):
+
+        # nvidia-smi keeps running and prints one line per GPU each loop
+        # period, so the driver is only initialised once rather than on every
+        # sample. The period is how often a GPU reading is used; its own timer
+        # still drifts from the sampler's, which the reader thread below absorbs
+        loop_ms = int(max(self.sample_interval, GPU_CACHE_TTL) * 1000)
+        self._smi_max_age = SMI_STALE_PERIODS * loop_ms / 1000
+        command = NVIDIA_SMI_COMMAND + ['-lms', str(loop_ms)]
+        self._smi = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1)
+
+        # the pipe is drained by its own thread so sampling never waits on it
+        self._smi_reading = (time.monotonic(), None)
+        threading.Thread(target=self.smi_reader_loop, args=(self._smi,), daemon=True).start()
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def smi_reader_loop(self, smi):
+
+        # keep only the newest line of each GPU, keyed by its index, and when
+        # the last one arrived; older lines are overwritten rather than
+        # queueing up behind them
+        lines = {}
+        with smi.stdout:
+            for line in smi.stdout:
+                index, _, values = line.partition(',')
+                lines[index.strip()] = values
+                if smi is self._smi:
+                    self._smi_reading = (time.monotonic(), tuple(lines.values()))
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def close(self):
+
+        # a None entry tells the writer to finish what is queued and stop
+        if self._db_writer.is_alive():
+            self._db_queue.put(None)
+            self._db_writer.join()
+
+        if self._smi is not None and self._smi.poll() is None:
+            self._smi.terminate()
+            self._smi.wait()
+
+        if self._nvml_handles:
+            self._nvml_handles = None
+            self.shutdown_nvml()
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def read_gpu_usage(self):
+
+        readings = []
+
+        if self._nvml_reinit:
+            # first poll after the back-off; look the devices up again
+            self._nvml_handles = self.init_nvml()
+            if not self._nvml_handles:
+                raise RuntimeError("NVML could not be initialised")
+            self._nvml_reinit = False
+
+        if self._nvml_handles:
+            try:
+                for handle in self._nvml_handles:
+                    utilization = pynvml.nvmlDeviceGetUtilizationRates(handle)
+                    memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                    readings.append((utilization.gpu, memory.used // (1024 * 1024), memory.total // (1024 * 1024)))
+            except pynvml.NVMLError:
+                # a driver reload leaves the handles invalid, so every later
+                # call would fail too; start NVML over once the back-off ends
+                self._nvml_handles = None
+                self._nvml_reinit = True
+                self.shutdown_nvml()
+                raise
+        elif self._smi is not None:
+            # the loop process exits if the driver goes away; that fails this
+            # poll and a new one is started on the first poll after the
+            # back-off, so a broken card costs one spawn per window
+            if self._smi_restart:
+                self._smi_restart = False
+                self.start_nvidia_smi()
+            elif self._smi.poll() is not None:
+                self._smi_restart = True
+                raise RuntimeError(f"nvidia-smi exited with status {self._smi.returncode}")
+
+            arrived, lines = self._smi_reading
+            age = time.monotonic() - arrived
+            if age > self._smi_max_age:
+                # a hung nvidia-smi never exits by itself; stop it so this counts
+                # as a failure and the poll after the back-off starts a new one
+                self._smi.kill()
+                self._smi.wait()
+                self._smi_restart = True
+                raise RuntimeError(f"no new nvidia-smi reading in {age:.0f} s")
+            if lines is None:
+                # just started and nothing to report yet
+                return None
+            readings = [map(int, line.split(',')) for line in lines]
+
+        return combine_gpu_readings(readings)
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def get_current_gpu_usage(self):
 
-        gpu_proc_usage = 0
-        gpu_mem_used = 0
-        gpu_mem_total = 0
+        # the last reading stays in current_usage_stats until the cache expires,
+        # and after a failure polling is paused until the back-off runs out
+        now = time.monotonic()
+        if now - self._gpu_last_poll < GPU_CACHE_TTL or now < self._gpu_next_poll:
+            return
+        self._gpu_last_poll = now
 
-        if self.gpu_type == GPUType.NVIDIA_GPU:
-            result = subprocess.run(NVIDIA_SMI_COMMAND, shell=True, capture_output=True, text=True, check=True)
-            gpu_proc_usage = int(result.stdout.split(',')[0].strip())
-            gpu_mem_used = int(result.stdout.split(',')[1].strip())
-            gpu_mem_total = int(result.stdout.split(',')[2].strip())
-        elif self.gpu_type == GPUType.AMD_GPU:
-            pass
+        try:
+            reading = self.read_gpu_usage()
+        except Exception as e:
+            # double the wait after each consecutive failure, up to GPU_BACKOFF_MAX
+            self._gpu_failures += 1
+            delay = min(GPU_BACKOFF_MAX, 2 ** self._gpu_failures)
+            self._gpu_next_poll = now + delay
+            print(f"GPU poll failed, retrying in {delay} s: {e}")
+            reading = None
+
+        # only a real reading ends the back-off; until then report no usage
+        # rather than the last good reading as if it were live
+        if reading is not None:
+            self._gpu_failures = 0
+        gpu_proc_usage, gpu_mem_used, gpu_mem_total = reading or (0, 0, 0)
 
         self.current_usage_stats.gpu_proc = gpu_proc_usage
         self.current_usage_stats.gpu_mem_used = gpu_mem_used
@@ -140,11 +439,19 @@ class VMMonitor():
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def get_current_usage(self):
-        cpu = psutil.cpu_percent(interval=1, percpu=True)
+        cpu = psutil.cpu_percent(interval=None, percpu=True)
+        if len(cpu) != self._num_listed_cpus:
+            # a CPU went on or offline; the peaks so far no longer line up
+            self.set_cpus(len(cpu))
         mem = psutil.virtual_memory()
-        disk = psutil.disk_usage('/')
 
-        self.current_usage_stats.cpu = cpu
+        # disk usage moves slowly, so skip the statvfs call between refreshes
+        now = time.monotonic()
+        if self._disk_cache[1] is None or now - self._disk_cache[0] >= self._disk_cache_ttl:
+            self._disk_cache = (now, psutil.disk_usage('/'))
+        disk = self._disk_cache[1]
+
+        np.take(cpu, self._cpu_positions, out=self.current_usage_stats.cpu)
         self.current_usage_stats.mem_used_mb = mem.used // (1024 * 1024)
         self.current_usage_stats.mem_total_mb = mem.total // (1024 * 1024)
         self.current_usage_stats.disk_used_mb = disk.used // (1024 * 1024)
@@ -157,8 +464,7 @@ class VMMonitor():
 
     def update_peak_usage(self):
 
-        for i in range(self.num_cpus):
-            self.peak_usage_stats.cpu[i] = max(self.peak_usage_stats.cpu[i], self.current_usage_stats.cpu[i])
+        np.maximum(self.peak_usage_stats.cpu, self.current_usage_stats.cpu, out=self.peak_usage_stats.cpu)
 
         self.peak_usage_stats.mem_used_mb = max(self.peak_usage_stats.mem_used_mb, self.current_usage_stats.mem_used_mb)
         self.peak_usage_stats.disk_used_mb = max(self.peak_usage_stats.disk_used_mb, self.current_usage_stats.disk_used_mb)
@@ -177,58 +483,82 @@ class VMMonitor():
         if self.num_cpus == 1:
             return f"{self.peak_usage_stats.cpu[0]:.1f}"
         else:
-            avg_cpu = sum(self.peak_usage_stats.cpu) / self.num_cpus
+            avg_cpu = self.peak_usage_stats.cpu.mean()
             return f"{avg_cpu:.1f} ({', '.join(f'{c:.1f}' for c in self.peak_usage_stats.cpu)})"
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def display(self):
-        print(f"Current Usage: {self.current_usage_stats}")
-        print(f"Peak Usage: {self.peak_usage_stats}")
-        print("-" * len(str(self.current_usage_stats)))
+
+        # format each stats object once and hand stdout a single write
+        current = str(self.current_usage_stats)
+        peak = str(self.peak_usage_stats)
+        sys.stdout.write(f"Current Usage: {current}\nPeak Usage: {peak}\n{'-' * len(current)}\n")
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def log_peak_stats(self):
 
+        # children are attached through the relationships so the whole sample
+        # is written by a single flush; the per-CPU peaks are packed into one
+        # column, which also copies them before the peak array is reset
         sample = Sample(timestamp=datetime.now(),
                         cpu_count=self.num_cpus,
-                        gpu_count=self.num_gpus)
-        self.db_session.add(sample)
-        self.db_session.commit()
-
-        for i, cpu_usage in enumerate(self.peak_usage_stats.cpu):
-            cpu_record = CPUUsage(  sample_id=sample.id,
-                                    cpu_index=i,
-                                    usage_percent=cpu_usage)
-            self.db_session.add(cpu_record)
-
-        mem_record = MemoryUsage(   sample_id=sample.id,
-                                    total_mb=self.peak_usage_stats.mem_total_mb,
-                                    used_mb=self.peak_usage_stats.mem_used_mb)
+                        gpu_count=self.num_gpus,
+                        cpu_usages=pack_cpu_usages(self.peak_usage_stats.cpu),
+                        cpu_ids=self._packed_cpu_ids)
 
-        self.db_session.add(mem_record)
+        sample.memory = MemoryUsage(total_mb=self.peak_usage_stats.mem_total_mb,
+                                    used_mb=self.peak_usage_stats.mem_used_mb)
 
-        disk_record = DiskUsage(sample_id=sample.id,
-                                total_mb=self.peak_usage_stats.disk_total_mb,
+        sample.disk = DiskUsage(total_mb=self.peak_usage_stats.disk_total_mb,
                                 used_mb=self.peak_usage_stats.disk_used_mb)
-        self.db_session.add(disk_record)
 
         if not self.gpu_type == GPUType.CPU_ONLY:
-            gpu_record = GPUUsage(  sample_id=sample.id,
-                                    gpu_index=0,
+            sample.gpus = [GPUUsage(gpu_index=0,
                                     usage_percent=self.peak_usage_stats.gpu_proc,
                                     memory_used_mb=self.peak_usage_stats.gpu_mem_used,
-                                    memory_total_mb=self.peak_usage_stats.gpu_mem_total)
-            self.db_session.add(gpu_record)
+                                    memory_total_mb=self.peak_usage_stats.gpu_mem_total)]
+
+        try:
+            self._db_queue.put_nowait(sample)
+        except queue.Full:
+            print("Database writer is falling behind, dropping sample")
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def db_writer_loop(self):
 
-        self.db_session.commit()
+        while True:
+            batch = [self._db_queue.get()]
+
+            # anything else already waiting shares the same commit
+            while len(batch) < DB_WRITE_BATCH:
+                try:
+                    batch.append(self._db_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            samples = [sample for sample in batch if sample is not None]
+            if samples:
+                try:
+                    self.db_session.add_all(samples)
+                    self.db_session.commit()
+                except Exception as e:
+                    self.db_session.rollback()
+                    print(f"Failed to write {len(samples)} sample(s): {e}")
+
+            if len(samples) < len(batch):
+                return
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def run(self):
 
-        next_report = datetime.now() + timedelta(seconds=self.report_interval)
+        # deadlines are kept on the monotonic clock so they advance by a fixed
+        # step instead of drifting by however long each sample took
+        next_sample = time.monotonic()
+        next_report = next_sample + self.report_interval
 
         while True:
             self.get_current_usage()
@@ -236,22 +566,40 @@ class VMMonitor():
             self.update_peak_usage()
 
             # check if it's time to log the hourly peak
-            if datetime.now() >= next_report:
+            now = time.monotonic()
+            if now >= next_report:
 
                 self.log_peak_stats()
 
                 # reset peak stats for the next interval
                 self.peak_usage_stats.reset()
 
-                # reset the next report time
-                next_report = datetime.now() + timedelta(seconds=self.report_interval)
+                # move on to the next report time still ahead, skipping any
+                # reports missed while the process was stalled
+                next_report += ((now - next_report) // self.report_interval + 1) * self.report_interval
 
-            time.sleep(self.sample_interval)
+            # skip ticks missed during a stall instead of sampling back to back,
+            # keeping to the original phase
+            now = time.monotonic()
+            next_sample += self.sample_interval
+            if next_sample < now:
+                next_sample += ((now - next_sample) // self.sample_interval + 1) * self.sample_interval
+            time.sleep(next_sample - now)
 
 # =================================================================================
 
+def handle_sigterm(signum, frame):
+
+    # systemd stops the service with SIGTERM, which would skip the atexit
+    # handlers that flush queued samples and stop nvidia-smi
+    sys.exit(0)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
 def main(config_dict : dict):
 
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
     monitor = VMMonitor(sample_interval=config_dict[SAMPLE_INTERVAL],
                         report_interval=config_dict[REPORT_INTERVAL],
                         db_file_path=config_dict[DB_FILE_PATH])
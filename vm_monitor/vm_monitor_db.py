@@ -1,5 +1,8 @@
+import itertools
+import numpy as np
 from datetime import datetime
-from sqlalchemy import (Column, Integer, Float, String, ForeignKey, DateTime, text)
+from functools import lru_cache
+from sqlalchemy import (Column, Integer, Float, String, ForeignKey, DateTime, LargeBinary, Index, event, inspect, text)
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -8,6 +11,24 @@ from sqlalchemy.orm import sessionmaker
 
 Base = declarative_base()
 
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024    # bytes of the database file SQLite may memory-map
+CPU_USAGE_DTYPE = np.float32            # element type of the packed per-CPU usage column
+CPU_ID_DTYPE = np.uint16                # element type of the packed CPU id column
+MIGRATION_BATCH_SIZE = 1000             # samples updated per statement when migrating old databases
+SQLITE_BUSY_TIMEOUT = 60                # seconds to wait for another process to release the write lock
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _default_cpu_avg_percent(context):
+    """Mean of the sample's packed per-CPU usages"""
+    return summarize_cpu_usages(unpack_cpu_usages(context.get_current_parameters().get('cpu_usages')))[0]
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _default_cpu_max_percent(context):
+    """Highest of the sample's packed per-CPU usages"""
+    return summarize_cpu_usages(unpack_cpu_usages(context.get_current_parameters().get('cpu_usages')))[1]
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 class Sample(Base):
     __tablename__ = "samples"
@@ -18,31 +39,27 @@ class Sample(Base):
     cpu_count = Column(Integer)
     gpu_count = Column(Integer)
 
-    cpus = relationship("CPUUsage", back_populates="sample", cascade="all, delete-orphan")
+    # per-CPU usage percentages packed as CPU_USAGE_DTYPE, and the kernel CPU
+    # id of each one packed as CPU_ID_DTYPE; NULL ids mean 0 to cpu_count - 1
+    cpu_usages = Column(LargeBinary)
+    cpu_ids = Column(LargeBinary)
+
+    # mean and highest of cpu_usages, kept beside them so SQL can aggregate
+    # CPU usage without unpacking every sample
+    cpu_avg_percent = Column(Float, default=_default_cpu_avg_percent)
+    cpu_max_percent = Column(Float, default=_default_cpu_max_percent)
+
     gpus = relationship("GPUUsage", back_populates="sample", cascade="all, delete-orphan")
     disk = relationship("DiskUsage", back_populates="sample", uselist=False, cascade="all, delete-orphan")
     memory = relationship("MemoryUsage", back_populates="sample", uselist=False, cascade="all, delete-orphan")
 
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# CPU Metrics
-class CPUUsage(Base):
-    __tablename__ = "cpu_usage"
-
-    id = Column(Integer, primary_key=True)
-    sample_id = Column(Integer, ForeignKey("samples.id", ondelete="CASCADE"), index=True)
-    cpu_index = Column(Integer)
-    usage_percent = Column(Float)
-
-    sample = relationship("Sample", back_populates="cpus")
-
-
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # GPU Metrics
 class GPUUsage(Base):
     __tablename__ = "gpu_usage"
 
     id = Column(Integer, primary_key=True)
-    sample_id = Column(Integer, ForeignKey("samples.id", ondelete="CASCADE"), index=True)
+    sample_id = Column(Integer, ForeignKey("samples.id", ondelete="CASCADE"))
     gpu_index = Column(Integer)
     usage_percent = Column(Float)
     memory_used_mb = Column(Float)
@@ -50,6 +67,10 @@ class GPUUsage(Base):
 
     sample = relationship("Sample", back_populates="gpus")
 
+    # covers the per-sample lookups, so range queries never touch the table itself
+    __table_args__ = (Index("ix_gpu_usage_sample_cover",
+                            sample_id, gpu_index, usage_percent, memory_used_mb, memory_total_mb),)
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Disk Metrics
 class DiskUsage(Base):
@@ -76,19 +97,151 @@ class MemoryUsage(Base):
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Configure a new SQLite connection"""
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    # WAL lets a commit append to the log instead of rewriting the journal,
+    # and NORMAL only fsyncs at checkpoints
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def pack_cpu_usages(cpu_usages):
+    """Pack per-CPU usage percentages into bytes for Sample.cpu_usages"""
+    return np.asarray(cpu_usages, dtype=CPU_USAGE_DTYPE).tobytes()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def unpack_cpu_usages(packed):
+    """Unpack Sample.cpu_usages into an array of per-CPU usage percentages"""
+    return np.frombuffer(packed or b'', dtype=CPU_USAGE_DTYPE)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def summarize_cpu_usages(cpu_usages):
+    """Mean and highest of a sample's per-CPU usages, None for a sample without any"""
+    if not len(cpu_usages):
+        return None, None
+    return float(np.mean(cpu_usages)), float(np.max(cpu_usages))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def pack_cpu_ids(cpu_ids):
+    """Pack the CPU ids of a sample's usages for Sample.cpu_ids, None when they are 0 to n - 1"""
+    if list(cpu_ids) == list(range(len(cpu_ids))):
+        return None
+    return np.asarray(cpu_ids, dtype=CPU_ID_DTYPE).tobytes()
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def unpack_cpu_ids(packed, cpu_count):
+    """Unpack Sample.cpu_ids into an array with the CPU id of each usage"""
+    if packed is None:
+        return np.arange(cpu_count)
+    return np.frombuffer(packed, dtype=CPU_ID_DTYPE)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def _upgrade_schema(conn):
+    """Bring a database written by an older version up to the current schema"""
+
+    inspector = inspect(conn)
+    sample_columns = {column['name'] for column in inspector.get_columns('samples')}
+
+    if 'cpu_usages' not in sample_columns:
+        conn.execute(text("ALTER TABLE samples ADD COLUMN cpu_usages BLOB"))
+
+    if 'cpu_ids' not in sample_columns:
+        conn.execute(text("ALTER TABLE samples ADD COLUMN cpu_ids BLOB"))
+
+    add_cpu_summary = 'cpu_avg_percent' not in sample_columns
+    if add_cpu_summary:
+        conn.execute(text("ALTER TABLE samples ADD COLUMN cpu_avg_percent FLOAT"))
+        conn.execute(text("ALTER TABLE samples ADD COLUMN cpu_max_percent FLOAT"))
+
+    # older versions stored one row per CPU per sample; fold those rows into
+    # the packed column and drop the table
+    if inspector.has_table('cpu_usage'):
+        rows = conn.execute(text("SELECT sample_id, usage_percent FROM cpu_usage "
+                                 "ORDER BY sample_id, cpu_index"))
+        packed = ({ 'id': sample_id,
+                    'cpu_usages': pack_cpu_usages([row.usage_percent for row in group])}
+                  for sample_id, group in itertools.groupby(rows, key=lambda row: row.sample_id))
+
+        update = text("UPDATE samples SET cpu_usages = :cpu_usages WHERE id = :id")
+        while batch := list(itertools.islice(packed, MIGRATION_BATCH_SIZE)):
+            conn.execute(update, batch)
+
+        conn.execute(text("DROP TABLE cpu_usage"))
+
+    # fill in the summary of every sample stored before it existed, a batch
+    # of samples at a time
+    if add_cpu_summary:
+        select_batch = text("SELECT id, cpu_usages FROM samples WHERE id > :last_id "
+                            "AND length(cpu_usages) > 0 ORDER BY id LIMIT :limit")
+        update = text("UPDATE samples SET cpu_avg_percent = :avg, cpu_max_percent = :max WHERE id = :id")
+        last_id = -1
+        while rows := conn.execute(select_batch, {'last_id': last_id, 'limit': MIGRATION_BATCH_SIZE}).all():
+            summaries = (summarize_cpu_usages(unpack_cpu_usages(row.cpu_usages)) for row in rows)
+            conn.execute(update, [{'id': row.id, 'avg': avg, 'max': highest}
+                                  for row, (avg, highest) in zip(rows, summaries)])
+            last_id = rows[-1].id
+
+    # create_all skips tables that already exist, indexes included
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+    # superseded by the covering index, which starts with the same column
+    conn.execute(text("DROP INDEX IF EXISTS ix_gpu_usage_sample_id"))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
 def create_database_engine(database_file_path):
     """Create and return a SQLAlchemy engine"""
 
-    # Create SQLite engine
-    engine = create_engine(f'sqlite:///{database_file_path}', echo=False)
+    # Create SQLite engine; the client writes from a background thread
+    engine = create_engine( f'sqlite:///{database_file_path}',
+                            echo=False,
+                            connect_args={  'check_same_thread': False,
+                                            'timeout': SQLITE_BUSY_TIMEOUT})
+
+    # most of these PRAGMAs only last for one connection, so apply them to every
+    # connection the pool opens rather than just the first one
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
+
+    # the client and the API start together and both get here, so take the
+    # write lock before looking at the schema; otherwise both can see the same
+    # old schema and the slower one fails halfway through its upgrade.
+    # AUTOCOMMIT stops the driver from issuing its own BEGIN/COMMIT around ours
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            # Create all tables
+            Base.metadata.create_all(conn)
+            _upgrade_schema(conn)
+        except BaseException:
+            conn.exec_driver_sql("ROLLBACK")
+            raise
+        conn.exec_driver_sql("COMMIT")
 
-    with engine.connect() as conn:
-        conn.execute(text("PRAGMA foreign_keys=ON"))
+    return engine
 
-    # Create all tables
-    Base.metadata.create_all(engine)
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    return engine
+@lru_cache(maxsize=None)
+def get_session_factory(database_file_path):
+    """Get the sessionmaker for a database, creating its engine on first use"""
+
+    # create_all and the connection setup only need to happen once per file
+    engine = create_database_engine(database_file_path)
+    return sessionmaker(bind=engine)
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -96,8 +249,7 @@ def get_session(database_file_path):
     """Get a database session"""
 
     try:
-        engine = create_database_engine(database_file_path)
-        SessionLocal = sessionmaker(bind=engine)
+        SessionLocal = get_session_factory(database_file_path)
         return SessionLocal()
     except Exception as e:
         raise e